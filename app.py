@@ -10,10 +10,14 @@ __version__ = "1.1.0"
 __copyright__ = "The University of Queensland, 2019"
 
 import math
+from enum import IntEnum
+import re
+from collections import defaultdict
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog
-from typing import Tuple, List
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import sys
+import time
 import pymunk
 import os
 
@@ -29,15 +33,26 @@ from player import Player
 BLOCK_SIZE = 2 ** 4
 MAX_WINDOW_SIZE = (1080, math.inf)
 JUMP_SIZE = 10
+STEP_TIME = 0.01  # seconds of game time per physics step
+MAX_STEPS_PER_TICK = 5
+FRAME_TIME = 1 / 60  # minimum seconds between redraws
+HASH_CELL_SIZE = BLOCK_SIZE * 2
+
+
+class BID(IntEnum):
+    """Ids of the special blocks defined in this module"""
+    TUNNEL = 1
+    FLAG = 2
+    BOUNCE = 3
+    SWITCH = 4
+
 
 GOAL_SIZES = {
-    "flag": (0.2, 9),
-    "tunnel": (2, 2)
-}
-TIMING = {
-    "invincibility" : 10000,
-    "switch": 1000
+    BID.FLAG: (0.2, 9),
+    BID.TUNNEL: (2, 2)
 }
+TIMING_INVINCIBILITY = 10000
+TIMING_SWITCH = 1000
 
 BLOCKS = {
     '#': 'brick',
@@ -61,6 +76,24 @@ MOBS = {
     '@': "mushroom"
 }
 
+CONFIG_SECTION = re.compile(r"^==(.+)==[ \t]*$", re.M)
+CONFIG_ENTRY = re.compile(r"^[ \t]*(\w+)[ \t]*:[ \t]*(.*?)[ \t]*$", re.M)
+# Attribute name and type of each required config value, by section and key
+CONFIG_FIELDS = {
+    "World": {
+        "gravity": ("global_gravity", int),
+        "start": ("current_level", str)
+    },
+    "Player": {
+        "character": ("character", str),
+        "x": ("x_start", int),
+        "y": ("y_start", int),
+        "mass": ("mass", int),
+        "health": ("health", int),
+        "max_velocity": ("max_velocity", int)
+    }
+}
+
 
 def create_block(world: World, block_id: str, x: int, y: int, *args):
     """Create a new block instance and add it to the world based on the block_id.
@@ -72,18 +105,8 @@ def create_block(world: World, block_id: str, x: int, y: int, *args):
         y (int): The y coordinate of the block.
     """
     block_id = BLOCKS[block_id]
-    if block_id == "mystery_empty":
-        block = MysteryBlock()
-    elif block_id == "mystery_coin":
-        block = MysteryBlock(drop="coin", drop_range=(3, 6))
-    elif block_id == "tunnel":
-        block = Tunnel()
-    elif block_id == "flag":
-        block = Flag()
-    elif block_id == "switch":
-        block = Switch()
-    else:
-        block = Block(block_id)
+    factory = BLOCK_FACTORIES.get(block_id)
+    block = factory() if factory is not None else Block(block_id)
 
     world.add_block(block, x * BLOCK_SIZE, y * BLOCK_SIZE)
 
@@ -98,12 +121,8 @@ def create_item(world: World, item_id: str, x: int, y: int, *args):
         y (int): The y coordinate of the item.
     """
     item_id = ITEMS[item_id]
-    if item_id == "coin":
-        item = Coin()
-    elif item_id == "star":
-        item = Star()
-    else:
-        item = DroppedItem(item_id)
+    factory = ITEM_FACTORIES.get(item_id)
+    item = factory() if factory is not None else DroppedItem(item_id)
 
     world.add_item(item, x * BLOCK_SIZE, y * BLOCK_SIZE)
 
@@ -118,14 +137,8 @@ def create_mob(world: World, mob_id: str, x: int, y: int, *args):
         y (int): The y coordinate of the mob.
     """
     mob_id = MOBS[mob_id]
-    if mob_id == "cloud":
-        mob = CloudMob()
-    elif mob_id == "fireball":
-        mob = Fireball()
-    elif mob_id == "mushroom":
-        mob = Mushroom()
-    else:
-        mob = Mob(mob_id, size=(1, 1))
+    factory = MOB_FACTORIES.get(mob_id)
+    mob = factory() if factory is not None else Mob(mob_id, size=(1, 1))
 
     world.add_mob(mob, x * BLOCK_SIZE, y * BLOCK_SIZE)
 
@@ -140,11 +153,9 @@ BLOCK_IMAGES = {
     "brick": "brick",
     "brick_base": "brick_base",
     "cube": "cube",
-    "bounce_block": "bounce_block",
-    "tunnel": "tunnel",
-    "flag": "flag",
-    "switch": "switch",
-    "switch_pressed": "switch_pressed"
+    BID.BOUNCE: "bounce_block",
+    BID.TUNNEL: "tunnel",
+    BID.FLAG: "flag"
 }
 
 ITEM_IMAGES = {
@@ -162,15 +173,107 @@ MOB_IMAGES = {
 class MarioViewRenderer(ViewRenderer):
     """A customised view renderer for a game of mario."""
 
+    MYSTERY_ACTIVE_IMAGE = "coin"
+    MYSTERY_USED_IMAGE = "coin_used"
+    SWITCH_IMAGE = "switch"
+    SWITCH_PRESSED_IMAGE = "switch_pressed"
+
+    def __init__(self, block_images: Dict[Union[str, BID], str],
+                 item_images: Dict[str, str], mob_images: Dict[str, str]):
+        super().__init__(block_images, item_images, mob_images)
+        # Sprite selector for each entity type, resolved on first use
+        self._sprite_selectors: Dict[type, Callable[[Entity], Optional[str]]] = {}
+        # Loaded images by name
+        self._img_cache: Dict[str, tk.PhotoImage] = {}
+        # Right and left facing image names, by character name
+        self._player_sprites: Dict[str, Tuple[str, str]] = {}
+
+    def load_image(self, name: str) -> tk.PhotoImage:
+        """Load an image by name, reusing the image if it was loaded before.
+
+        Parameters:
+            name (str): The name of the image.
+        """
+        image = self._img_cache.get(name)
+        if image is None:
+            image = self._img_cache[name] = super().load_image(name)
+        return image
+
+    def get_sprite_name(self, instance: Entity) -> Optional[str]:
+        """Return the name of the image used to draw an entity.
+
+        Parameters:
+            instance (Entity): The entity to be drawn.
+
+        Return:
+            str: The image name, or None if the entity isn't drawn with an image.
+        """
+        selector = self._sprite_selectors.get(type(instance))
+        if selector is None:
+            selector = self._sprite_selectors[type(instance)] = self._get_sprite_selector(instance)
+        return selector(instance)
+
+    def _get_sprite_selector(self, instance: Entity) -> Callable[[Entity], Optional[str]]:
+        """Return the function which picks the image name for entities of this type."""
+        if isinstance(instance, Player):
+            return self._get_player_sprite
+        if isinstance(instance, MysteryBlock):
+            return self._get_mystery_block_sprite
+        if isinstance(instance, Switch):
+            return self._get_switch_sprite
+        if isinstance(instance, Block):
+            return lambda block: BLOCK_IMAGES.get(block.get_id())
+        if isinstance(instance, DroppedItem):
+            return lambda item: ITEM_IMAGES.get(item.get_id())
+        if isinstance(instance, Mob):
+            return lambda mob: MOB_IMAGES.get(mob.get_id())
+        return lambda entity: None
+
+    def preload_images(self, character: str):
+        """Load every image the renderer can pick ahead of the first frame.
+        Images which fail to load are skipped, and fail when first drawn instead.
+
+        Parameters:
+            character (str): The name of the player's character.
+        """
+        names = [*self._get_player_sprites(character), self.MYSTERY_ACTIVE_IMAGE,
+                 self.MYSTERY_USED_IMAGE, self.SWITCH_IMAGE, self.SWITCH_PRESSED_IMAGE]
+        for images in (BLOCK_IMAGES, ITEM_IMAGES, MOB_IMAGES):
+            names.extend(images.values())
+
+        for name in names:
+            try:
+                self.load_image(name)
+            except tk.TclError:
+                pass
+
+    def _get_player_sprites(self, name: str) -> Tuple[str, str]:
+        """Return the right and left facing image names of a character."""
+        sprites = self._player_sprites.get(name)
+        if sprites is None:
+            sprites = self._player_sprites[name] = (name + "_right", name + "_left")
+        return sprites
+
+    def _get_player_sprite(self, instance: Player) -> str:
+        sprites = self._get_player_sprites(instance.get_name())
+        if instance.get_velocity()[0] >= 0:
+            return sprites[0]
+        return sprites[1]
+
+    def _get_mystery_block_sprite(self, instance: MysteryBlock) -> str:
+        if instance.is_active():
+            return self.MYSTERY_ACTIVE_IMAGE
+        return self.MYSTERY_USED_IMAGE
+
+    def _get_switch_sprite(self, instance: "Switch") -> str:
+        if instance.is_active():
+            return self.SWITCH_PRESSED_IMAGE
+        return self.SWITCH_IMAGE
+
     @ViewRenderer.draw.register(Player)
     def _draw_player(self, instance: Player, shape: pymunk.Shape,
                      view: tk.Canvas, offset: Tuple[int, int]) -> List[int]:
-
-        if shape.body.velocity.x >= 0:
-
-            image = self.load_image(instance.get_name() + "_right")
-        else:
-            image = self.load_image(instance.get_name() + "_left")
+        image = self.load_image(self._get_player_sprite(instance))
 
         return [view.create_image(shape.bb.center().x + offset[0], shape.bb.center().y,
                                   image=image, tags="player")]
@@ -178,24 +281,68 @@ class MarioViewRenderer(ViewRenderer):
     @ViewRenderer.draw.register(MysteryBlock)
     def _draw_mystery_block(self, instance: MysteryBlock, shape: pymunk.Shape,
                             view: tk.Canvas, offset: Tuple[int, int]) -> List[int]:
-        if instance.is_active():
-            image = self.load_image("coin")
-        else:
-            image = self.load_image("coin_used")
+        image = self.load_image(self._get_mystery_block_sprite(instance))
 
         return [view.create_image(shape.bb.center().x + offset[0], shape.bb.center().y,
                                   image=image, tags="block")]
 
-    # @ViewRenderer.draw.register(Switch)
-    # def _draw_switch(self, instance: Switch, shape: pymunk.Shape,
-    #                         view: tk.Canvas, offset: Tuple[int, int]) -> List[int]:
-    #     if instance.is_active():
-    #         image = self.load_image("switch")
-    #     else:
-    #         image = self.load_image("switch_pressed")
-    #
-    #     return [view.create_image(shape.bb.center().x + offset[0], shape.bb.center().y,
-    #                               image=image, tags="block")]
+
+class SpatialHash:
+    """A uniform grid which buckets entities by the cell their position falls in,
+    so range queries only visit the entities in nearby cells.
+    """
+
+    def __init__(self, cell_size: float):
+        """Construct an empty spatial hash.
+
+        Parameters:
+            cell_size (float): The width and height of each cell in pixels.
+        """
+        self._cell_size = cell_size
+        self._cells: Dict[Tuple[int, int], List[Entity]] = defaultdict(list)
+        self._positions: Dict[int, Tuple[float, float]] = {}
+
+    def _get_cell(self, x: float, y: float) -> Tuple[int, int]:
+        return int(x // self._cell_size), int(y // self._cell_size)
+
+    def add(self, thing: Entity, x: float, y: float):
+        """Add an entity at the given position."""
+        self._positions[id(thing)] = (x, y)
+        self._cells[self._get_cell(x, y)].append(thing)
+
+    def remove(self, thing: Entity):
+        """Remove an entity, ignoring entities which were never added."""
+        position = self._positions.pop(id(thing), None)
+        if position is not None:
+            self._cells[self._get_cell(*position)].remove(thing)
+
+    def get_position(self, thing: Entity) -> Tuple[float, float]:
+        """Return the position an entity was added at."""
+        return self._positions[id(thing)]
+
+    def query_radius(self, x: float, y: float, radius: float) -> List[Entity]:
+        """Return all the entities within radius of a position.
+
+        Parameters:
+            x (float): The x coordinate of the centre of the query.
+            y (float): The y coordinate of the centre of the query.
+            radius (float): The maximum distance from the centre.
+        """
+        min_x, min_y = self._get_cell(x - radius, y - radius)
+        max_x, max_y = self._get_cell(x + radius, y + radius)
+        radius_squared = radius * radius
+
+        found = []
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                cell = (cell_x, cell_y)
+                if cell not in self._cells:
+                    continue
+                for thing in self._cells[cell]:
+                    thing_x, thing_y = self._positions[id(thing)]
+                    if (thing_x - x) ** 2 + (thing_y - y) ** 2 <= radius_squared:
+                        found.append(thing)
+        return found
 
 
 class MarioApp:
@@ -203,6 +350,12 @@ class MarioApp:
 
     _world: World
 
+    # Extra handling when the player leaves a block, by block id
+    _SEPARATE_HANDLERS = {
+        # Player is no longer on tunnel. No moving to bonus level
+        BID.TUNNEL: lambda self, player, block: self._set_on_tunnel(False)
+    }
+
     def __init__(self, master: tk.Tk):
         """Construct a new game of a MarioApp game.
 
@@ -214,6 +367,29 @@ class MarioApp:
 
         self.invincibility = False
         self._on_tunnel = False
+        self._paused = False
+
+        self._offset = (0, 0)
+        # Player x position the offset was last computed for
+        self._last_scroll_x = None
+        # Canvas item and image name of each drawn entity, keyed by id(entity)
+        self._canvas_items: Dict[int, int] = {}
+        self._canvas_sprites: Dict[int, str] = {}
+        # Last known centre of every entity in the world, drawn or not
+        self._positions: Dict[int, Tuple[float, float]] = {}
+        # Left, right, centre x and centre y of each block in the world
+        self._block_geometry: Dict[Block, Tuple[float, float, float, float]] = {}
+        # View offset the canvas items are currently drawn at
+        self._drawn_offset_x = 0
+        # Items drawn by the renderer for entities without an image
+        self._fallback_items: List[int] = []
+
+        # Redrawing is skipped while nothing in the scene changes
+        self._dirty = True
+        self._scene_moving = True
+        self._player_state = None
+        self._last_frame = 0.0
+        self._frame_overran = False
 
         world_builder = WorldBuilder(BLOCK_SIZE, gravity=(0, self.global_gravity), fallback=create_unknown)
         world_builder.register_builders(BLOCKS.keys(), create_block)
@@ -225,14 +401,25 @@ class MarioApp:
         self.reset_world(self.current_level)
 
         self._renderer = MarioViewRenderer(BLOCK_IMAGES, ITEM_IMAGES, MOB_IMAGES)
+        self._renderer.preload_images(self.character)
 
         size = tuple(map(min, zip(MAX_WINDOW_SIZE, self._world.get_pixel_size())))
         self._view = GameView(self._master, size, self._renderer)
+        self._view_width = size[0]
         self._view.pack()
         self.bind()
 
+        # Half the window width, updated whenever the window is resized
+        self._half_screen = size[0] / 2
+        self._master.bind("<Configure>", self._on_resize)
+
         # Wait for window to update before continuing
         self._master.update_idletasks()
+        self._last_step = time.perf_counter()
+        # Start with one step owed, so the world steps straight away
+        self._accumulator = STEP_TIME
+        # Id of the pending call to step
+        self._step_job = None
         self.step()
 
         menubar = tk.Menu(self._master)
@@ -253,42 +440,24 @@ class MarioApp:
         self.config_filename = input("What is the filename of the configuration file?")
         try:
             with open(self.config_filename) as f:
-                content = f.readlines()
-            self.config = {}
-            for line in content:
-                line = line.strip("\n")
-                if line.startswith("=="):
-                    current_line = line
-                    self.config[current_line] = []
-                else:
-                    self.config[current_line].append(line)
-
-            for config_data in self.config.keys():
-                if config_data == "==World==":
-                    # Gets world data
-                    for world_data in self.config["==World=="]:
-                        if world_data.startswith("gravity"):
-                            self.global_gravity = int(world_data.split(":")[-1].strip(" "))
-                        if world_data.startswith("start"):
-                            self.current_level = world_data.split(":")[-1].strip(" ")
-                if config_data == "==Player==":
-                    # Gets player data
-                    for player_data in self.config["==Player=="]:
-                        if player_data.startswith("character"):
-                            self.character = player_data.split(":")[-1].strip(" ")
-                        if player_data.startswith("x"):
-                            self.x_start = int(player_data.split(":")[-1].strip(" "))
-                        if player_data.startswith("y"):
-                            self.y_start = int(player_data.split(":")[-1].strip(" "))
-                        if player_data.startswith("mass"):
-                            self.mass = int(player_data.split(":")[-1].strip(" "))
-                        if player_data.startswith("health"):
-                            self.health = int(player_data.split(":")[-1].strip(" "))
-                        if player_data.startswith("max_velocity"):
-                            self.max_velocity = int(player_data.split(":")[-1].strip(" "))
-        except:
+                content = f.read()
+            # Splitting on the headers alternates section names and their contents
+            parts = CONFIG_SECTION.split(content)
+            sections = {name: dict(CONFIG_ENTRY.findall(body))
+                        for name, body in zip(parts[1::2], parts[2::2])}
+
+            for section, fields in CONFIG_FIELDS.items():
+                values = sections.pop(section, {})
+                for key, (attribute, convert) in fields.items():
+                    if key not in values:
+                        raise ValueError("missing {} in =={}==".format(key, section))
+                    setattr(self, attribute, convert(values[key]))
+
+            # The remaining sections map goal types to the next level, by level name
+            self.level_goals: Dict[str, Dict[str, str]] = sections
+        except (OSError, ValueError) as error:
             # Closes the program if wrong config
-            message = messagebox.showinfo("Information", "Config file invalid")
+            message = messagebox.showinfo("Information", "Config file invalid: {}".format(error))
             if message == "ok":
                 self._master.destroy()
                 sys.exit()
@@ -306,9 +475,9 @@ class MarioApp:
         :param type: (Str) type of goal, flag or tunnel
         """
         self.highscore()
-        for i in self.config["==" + self.current_level + "=="]:
-            if i.startswith(type):
-                self.reset_world(i.split(":")[-1].strip(" "))
+        target = self.level_goals.get(self.current_level, {}).get(type)
+        if target is not None:
+            self.reset_world(target)
 
     def create_status_bar(self):
         """
@@ -341,7 +510,7 @@ class MarioApp:
         """
         self.invincibility = True
         self.update_status_bar()
-        self._master.after(TIMING["invincibility"], self.remove_invincibility)
+        self._master.after(TIMING_INVINCIBILITY, self.remove_invincibility)
 
     def remove_invincibility(self):
         """
@@ -426,12 +595,50 @@ class MarioApp:
         """
         When player dies, they are given an option to restart the level, or to quit
         """
-        MsgBox = tk.messagebox.askquestion("Dead!", "You have died. Would you like to restart the level?",
-                                           icon='warning')
-        if MsgBox == 'yes':
-            self.menu_reset_level()
-        else:
-            self.menu_exit()
+        if self._paused:
+            # Already waiting on a dialog
+            return
+        self._show_dialog("Dead!", "You have died. Would you like to restart the level?",
+                          [("Yes", self.menu_reset_level), ("No", self.menu_exit)])
+
+    def _show_dialog(self, title, message, buttons):
+        """
+        Pauses the game and shows a dialog without blocking the event loop.
+        Closing the window picks the last button.
+        :param title: (str) title of the dialog window
+        :param message: (str) message shown in the dialog
+        :param buttons: list of (label, command) pairs, one for each button
+        """
+        self._paused = True
+        dialog = tk.Toplevel(self._master)
+        dialog.title(title)
+        dialog.transient(self._master)
+        tk.Label(dialog, text=message).pack(padx=10, pady=10)
+        for label, command in buttons:
+            tk.Button(dialog, text=label,
+                      command=lambda command=command: self._close_dialog(dialog, command)
+                      ).pack(side=tk.LEFT, expand=True, padx=10, pady=10)
+        dialog.protocol("WM_DELETE_WINDOW", lambda: self._close_dialog(dialog, buttons[-1][1]))
+        # Keep mouse and keyboard input on the dialog until it is closed
+        dialog.focus_set()
+        dialog.grab_set()
+
+    def _close_dialog(self, dialog, command):
+        """
+        Closes a dialog, resumes the game and runs the chosen command
+        :param dialog: (tk.Toplevel) the dialog to close
+        :param command: function to call once the dialog is closed
+        """
+        dialog.destroy()
+        self._paused = False
+        # Resume straight away rather than on the next paused check, and don't
+        # owe the world any steps for the time spent paused
+        if self._step_job is not None:
+            self._master.after_cancel(self._step_job)
+        self._accumulator = 0.0
+        self._last_step = time.perf_counter()
+        self._step_job = self._master.after(1, self.step)
+        command()
 
     def highscore(self):
         """
@@ -475,9 +682,11 @@ class MarioApp:
         """
         Lets the player know the game has ended
         """
-        message = messagebox.showinfo("Information", "Congratulations, you have completed the game!")
-        if message == "ok":
-            self._master.destroy()
+        if self._paused:
+            # Already waiting on a dialog
+            return
+        self._show_dialog("Information", "Congratulations, you have completed the game!",
+                          [("OK", self.menu_exit)])
 
     def reset_world(self, new_level):
         """
@@ -488,28 +697,50 @@ class MarioApp:
             # If str is END, end the game
             self.game_end()
         else:
+            self._block_geometry.clear()
             self._world = load_world(self._builder, new_level)
             self._world.add_player(self._player, self.x_start, self.y_start, self.mass)
+            self._world_pixel_width = self._world.get_pixel_size()[0]
+            self._last_scroll_x = None
             self._builder.clear()
             self._setup_collision_handlers()
-
-    def unpress_switch(self, block, x, y, pressed_switch, positions):
-        """
-        After 10 seconds of the TIMIGS["switch"] is pressed, this function is called
-        :param block: the original switch
+            self._dirty = True
+
+            # Bricks don't move, so they are indexed once per level
+            self._brick_hash = SpatialHash(HASH_CELL_SIZE)
+            for thing in self._world.get_all_things():
+                if isinstance(thing, Block) and thing.get_id() == "brick":
+                    x, y = thing.get_position()
+                    self._brick_hash.add(thing, x, y)
+
+    def _add_block(self, block: Block, x: float, y: float):
+        """Add a block to the world, and to the spatial hash if it is a brick."""
+        self._world.add_block(block, x, y)
+        if block.get_id() == "brick":
+            self._brick_hash.add(block, x, y)
+        self._dirty = True
+
+    def _remove_block(self, block: Block):
+        """Remove a block from the world and from the spatial hash of bricks."""
+        self._world.remove_block(block)
+        self._brick_hash.remove(block)
+        self._dirty = True
+
+    def unpress_switch(self, block, x, y, bricks):
+        """
+        TIMING_SWITCH milliseconds after a switch is pressed, this function is called
+        :param block: the pressed switch
         :param x: x coordinate of the swithc
         :param y: y coordinate of the swithc
-        :param pressed_switch: the pressed switch object
-        :param positions: list of all positions of bricks to be replaces
-        """
-        block._switch = False
-        for i in positions:
-            self._world.add_block(Block("brick"), i[0], i[1])
-            # Add all the blocks that were removed
-        self._world.remove_block(pressed_switch)
-        # Remove pressed switch
-        self._world.add_block(block ,x ,y )
-        #
+        :param bricks: list of all the removed bricks and their positions
+        """
+        for brick, (brick_x, brick_y) in bricks:
+            self._add_block(brick, brick_x, brick_y)
+            # Add back the same bricks that were removed
+        self._remove_block(block)
+        block.release()
+        self._add_block(block, x, y)
+        # Re-add the released switch so anything touching it collides again
 
     def bind(self):
         """Bind all the keyboard events to their event handlers."""
@@ -519,68 +750,211 @@ class MarioApp:
         self._view.bind_all("<s>", self._duck)
         self._view.bind_all("<Down>", self._duck)
         self._view.bind_all("<Right>", lambda e: self._move(1, 0))
-        self._view.bind_all("<d>", lambda e: self._move(1, self._player.get_velocity()[1]))
+        self._view.bind_all("<d>", lambda e: self._move(1, 0))
         self._view.bind_all("<Left>", lambda e: self._move(-1, 0))
-        self._view.bind_all("<a>", lambda e: self._move(-1, self._player.get_velocity()[1]))
+        self._view.bind_all("<a>", lambda e: self._move(-1, 0))
 
     def redraw(self):
-        """Redraw all the entities in the game canvas."""
-        self._view.delete(tk.ALL)
-
-        self._view.draw_entities(self._world.get_all_things())
+        """Redraw the entities in the game canvas which are in view.
+
+        Canvas items are kept between frames. Only entities which came into or
+        went out of view get an item created or deleted. Scrolling shifts every
+        item with a single canvas move, after which only entities that moved in
+        the world are repositioned, and only those whose image changed are
+        reconfigured. Records whether any entity moved, appeared or disappeared
+        since the last redraw.
+        """
+        view = self._view
+        offset_x = self._offset[0]
+        # Visible range of x coordinates on the canvas, with a block of margin
+        view_left, view_right = -BLOCK_SIZE, self._view_width + BLOCK_SIZE
+
+        if self._fallback_items:
+            view.delete(*self._fallback_items)
+            self._fallback_items = []
+
+        if offset_x != self._drawn_offset_x:
+            view.move(tk.ALL, offset_x - self._drawn_offset_x, 0)
+            self._drawn_offset_x = offset_x
+
+        previous_items = self._canvas_items
+        previous_positions = self._positions
+        items = {}
+        positions = {}
+        moving = False
+        for thing in self._world.get_all_things():
+            key = id(thing)
+            geometry = self._block_geometry.get(thing)
+            if geometry is None:
+                bb = thing.get_shape().bb
+                center = bb.center()
+                geometry = (bb.left, bb.right, center.x, center.y)
+                if isinstance(thing, Block):
+                    # Blocks never move, so their shape is only read once
+                    self._block_geometry[thing] = geometry
+            left, right, x, y = geometry
+
+            position = (x, y)
+            positions[key] = position
+            moved = previous_positions.get(key) != position
+            if moved:
+                moving = True
+
+            if right + offset_x < view_left or left + offset_x > view_right:
+                # Out of view, any existing item is deleted below
+                continue
+
+            sprite = self._renderer.get_sprite_name(thing)
+            if sprite is None:
+                # No image to reuse, let the renderer draw it from scratch
+                self._fallback_items.extend(self._renderer.draw(thing, thing.get_shape(), view,
+                                                                self._offset))
+                continue
+
+            item = previous_items.pop(key, None)
+            if item is None:
+                item = view.create_image(x + offset_x, y, image=self._renderer.load_image(sprite))
+            else:
+                if moved:
+                    view.coords(item, x + offset_x, y)
+                if self._canvas_sprites[key] != sprite:
+                    view.itemconfig(item, image=self._renderer.load_image(sprite))
+            items[key] = item
+            self._canvas_sprites[key] = sprite
+
+        # Anything left over went out of view or is no longer in the world
+        for key, item in previous_items.items():
+            view.delete(item)
+            del self._canvas_sprites[key]
+        if len(positions) != len(previous_positions):
+            moving = True
+
+        self._canvas_items = items
+        self._positions = positions
+        self._scene_moving = moving
 
     def scroll(self):
         """Scroll the view along with the player in the center unless
         they are near the left or right boundaries
         """
         x_position = self._player.get_position()[0]
-        half_screen = self._master.winfo_width() / 2
-        world_size = self._world.get_pixel_size()[0] - half_screen
+        if x_position == self._last_scroll_x:
+            return
+        self._last_scroll_x = x_position
+
+        half_screen = self._half_screen
+        world_size = self._world_pixel_width - half_screen
+        offset = self._offset
 
         # Left side
         if x_position <= half_screen:
-            self._view.set_offset((0, 0))
+            offset = (0, 0)
 
         # Between left and right sides
         elif half_screen <= x_position <= world_size:
-            self._view.set_offset((half_screen - x_position, 0))
+            offset = (half_screen - x_position, 0)
 
         # Right side
         elif x_position >= world_size:
-            self._view.set_offset((half_screen - world_size, 0))
+            offset = (half_screen - world_size, 0)
 
-    def step(self):
-        """Step the world physics and redraw the canvas."""
-        data = (self._world, self._player)
-        self._world.step(data)
+        if offset != self._offset:
+            self._offset = offset
+            self._view.set_offset(offset)
 
-        self.scroll()
-        self.redraw()
+    def _on_resize(self, event: tk.Event):
+        """Cache the new window width when the window is resized."""
+        # Configure events of child widgets propagate to the root window too
+        if event.widget is self._master:
+            self._half_screen = event.width / 2
+            self._last_scroll_x = None
+            self._dirty = True
 
-        self._master.after(10, self.step)
+    def step(self):
+        """Step the world physics and redraw the canvas.
+
+        The physics always advances in fixed steps of STEP_TIME. Each call runs as
+        many steps as the time since the last call owes, up to MAX_STEPS_PER_TICK,
+        so the game speed doesn't depend on how often Tk calls back.
+
+        The canvas is only redrawn if the player moved, something in the scene
+        moved during the last redraw or the scene was changed by a collision or
+        input, and at most once every FRAME_TIME. A frame is skipped after a
+        redraw that took well over FRAME_TIME, to let the physics keep up.
+        While paused, only checks back periodically.
+        """
+        now = time.perf_counter()
+        if self._paused:
+            self._accumulator = 0.0
+            self._last_step = now
+            self._step_job = self._master.after(100, self.step)
+            return
+
+        self._accumulator += now - self._last_step
+        self._last_step = now
+        steps = 0
+        while self._accumulator >= STEP_TIME and not self._paused:
+            if steps == MAX_STEPS_PER_TICK:
+                # Too far behind to catch up, drop the time owed
+                self._accumulator = 0.0
+                break
+            # Collisions can change the world, so data is rebuilt every step
+            self._world.step((self._world, self._player))
+            self._accumulator -= STEP_TIME
+            steps += 1
+
+        player_state = (*self._player.get_position(), *self._player.get_velocity())
+        if player_state != self._player_state:
+            self._player_state = player_state
+            self._dirty = True
+
+        now = time.perf_counter()
+        if (self._dirty or self._scene_moving) and now - self._last_frame >= FRAME_TIME:
+            if self._frame_overran:
+                self._frame_overran = False
+            else:
+                self._dirty = False
+                self._last_frame = now
+                self.scroll()
+                self.redraw()
+                now = time.perf_counter()
+                self._frame_overran = now - self._last_frame > 1.5 * FRAME_TIME
+
+        # Call back when the next step is due
+        owed = self._accumulator + now - self._last_step
+        self._step_job = self._master.after(max(1, math.ceil((STEP_TIME - owed) * 1000)), self.step)
 
     def _move(self, dx, dy):
         """
         Moves the player to the side.
         """
+        if self._paused:
+            # The key bindings are global, so they still fire behind a dialog
+            return
         if dx > self.max_velocity:
             # Limit player velocity to max_velocity set in confif file
             dx = self.max_velocity
         self._player.set_velocity((dx * BLOCK_SIZE * 5, self._player.get_velocity()[1]))
+        self._dirty = True
 
     def _jump(self, e):
         """
         First check that player is not already jumping, but is on a block.
         If not jumping, jump
         """
+        if self._paused:
+            return
         if not self._player.is_jumping():
             self._player.set_velocity((self._player.get_velocity()[0], -BLOCK_SIZE * JUMP_SIZE))
+            self._dirty = True
 
     def _duck(self, e):
         """
         Handles when player ducks. If player on tunnel, move to bonus level, then set that
         player is no longer on tunnel
         """
+        if self._paused:
+            return
         if self._on_tunnel:
             self.goto_next_level("tunnel")
             self._set_on_tunnel(False)
@@ -605,16 +979,19 @@ class MarioApp:
         :param block: The block the mob collided with
         :return: (bool): True if mob can collide with block
         """
-        if mob.get_id() == "fireball":
-            if block.get_id() == "brick":
+        self._dirty = True
+        mob_id = mob.get_id()
+        block_id = block.get_id()
+        if mob_id == "fireball":
+            if block_id == "brick":
                 # If fireball collides with brick, remove both
-                self._world.remove_block(block)
+                self._remove_block(block)
             self._world.remove_mob(mob)
-        elif mob.get_id() == "mushroom":
+        elif mob_id == "mushroom":
             # If mushroom collides with the side of a brick, turn around
-            if get_collision_direction(block, mob) == "R" or get_collision_direction(block, mob) == "L":
+            if get_collision_direction(block, mob) in ("R", "L"):
                 mob.set_tempo(-mob.get_tempo())
-        elif block.get_id() == "switch_pressed":
+        elif block_id is BID.SWITCH and block.is_active():
             # Mob doesn't collide with pressed switch
             return False
         return True
@@ -637,11 +1014,14 @@ class MarioApp:
         :param mob2: The other mob
         :return: (bool): always returns false
         """
-        if mob1.get_id() == "fireball" or mob2.get_id() == "fireball":
+        self._dirty = True
+        mob1_id = mob1.get_id()
+        mob2_id = mob2.get_id()
+        if mob1_id == "fireball" or mob2_id == "fireball":
             # If fireball hits another mob, remove both
             self._world.remove_mob(mob1)
             self._world.remove_mob(mob2)
-        if mob1.get_id() == "mushroom" and mob2.get_id() == "mushroom":
+        if mob1_id == "mushroom" and mob2_id == "mushroom":
             # If mushrooms collide, both change direction
             mob1.set_tempo(-mob1.get_tempo())
             mob2.set_tempo(-mob2.get_tempo())
@@ -665,6 +1045,7 @@ class MarioApp:
                    (more generally, collision callbacks return True iff the collision should be considered valid; i.e.
                    returning False makes the world ignore the collision)
         """
+        self._dirty = True
         if dropped_item.get_id() == "star":
             # If player picks a star, make player invincible
             # See set_invincibility()
@@ -684,63 +1065,55 @@ class MarioApp:
         :param block: The block the player collided with
         :return: (bool): returns true if player can collide with block
         """
+        self._dirty = True
+        direction = get_collision_direction(block, player)
 
-        if get_collision_direction(block, player) == "B":
+        if direction == "B":
             # Set player jumping to false if landed on top of block
             # so player can jump
             self._player.set_jumping(False)
 
         block.on_hit(arbiter, (self._world, player))
 
-        if block.get_id() == "bounce_block":
+        block_id = block.get_id()
+        if block_id is BID.BOUNCE:
             # Player jumps when collides with bounce block
             self._jump(None)
-        if block.get_id() == "tunnel" and get_collision_direction(block, player) == "B":
+        if block_id is BID.TUNNEL and direction == "B":
             # If player ducks while on tunnel, move to next bonus level. See _duck()
             self._set_on_tunnel(True)
 
-        elif block.get_id() == "flag":
+        elif block_id is BID.FLAG:
             # If player collides with flag, move to next level.
             # If collides with top of flag, full health
-            if get_collision_direction(block, player) == "B":
+            if direction == "B":
                 self.goto_next_level("goal")
                 player.change_health(player.get_max_health() - player.get_health())
             else:
                 self.goto_next_level("goal")
-        elif block.get_id() == "switch_pressed":
-            # If switch is pressed, no colliding with it
-            return False
-        elif block.get_id() == "switch":
-            if not block._switch:
-                # If block is not switched
-                if get_collision_direction(block, player) == "B":
-                    # If landed on top of switch:
-                    # Remove all blocks in a range of 10 BLOCK_SIZE from the switch
-                    self._switch = True
-                    x, y = block.get_position()[0], block.get_position()[1] # x and y coordinates of the switch
-                    remove = self._world.get_things_in_range(x, y, BLOCK_SIZE * 10)
-                    # remove is a list of all the things in the range
-                    positions = []
-                    for i in remove:
-                        # Filtering only for bricks
-                        if i == player:
-                            pass
-                        elif i.get_id() == "brick":
-                            positions.append(i.get_position())
-                            # Store coordinates for all the bricks
-                            self._world.remove_block(i)
-                            # Remove bricks
-                    block._switch = True
-                    self._world.remove_block(block)
-                    # remove switch to be replace with pressed switch
-                    pressed_switch = Switch_Pressed()
-                    self._world.add_block(pressed_switch,x ,y)
-                    # Add the pressed switch blick
-                    self._master.after(TIMING["switch"], self.unpress_switch, block, x, y, pressed_switch, positions)
-                    # After 10 sec, replace pressed switch with original and replace bricks
-                    # See unpress_switch()
-            else:
+        elif block_id is BID.SWITCH:
+            if block.is_active():
+                # If switch is pressed, no colliding with it
                 return False
+            if direction == "B":
+                # If landed on top of switch:
+                # Remove all blocks in a range of 10 BLOCK_SIZE from the switch
+                x, y = block.get_position() # x and y coordinates of the switch
+                remove = self._brick_hash.query_radius(x, y, BLOCK_SIZE * 10)
+                # remove is a list of all the bricks in the range
+                bricks = []
+                for i in remove:
+                    bricks.append((i, self._brick_hash.get_position(i)))
+                    # Store all the bricks and their coordinates
+                    self._remove_block(i)
+                    # Remove bricks
+                self._remove_block(block)
+                block.press()
+                self._add_block(block, x, y)
+                # Re-add the pressed switch so the player's contact with it ends
+                self._master.after(TIMING_SWITCH, self.unpress_switch, block, x, y, bricks)
+                # After TIMING_SWITCH, release the switch and replace bricks
+                # See unpress_switch()
 
         return True
 
@@ -752,6 +1125,7 @@ class MarioApp:
         :param mob: the mob the player collided with
         :return: (bool): True if player can connect with mob
         """
+        self._dirty = True
         if self.invincibility:
             # if player is currently invincible, destroy mobs without loosing health
             self._world.remove_mob(mob)
@@ -761,15 +1135,16 @@ class MarioApp:
                 # If mob is mushroom,
                 # When the mob collides with the side of a player, the player should lose 1 health
                 # point and be slightly repelled away from the mob
-                if get_collision_direction(mob, player) == "R":
+                direction = get_collision_direction(mob, player)
+                if direction == "R":
                     # Hit right side of mob
                     player.change_health(-1)
                     player.set_velocity((-100, player.get_velocity()[1]))
-                elif get_collision_direction(mob, player) == "L":
+                elif direction == "L":
                     # Hit right side of mob
                     player.change_health(-1)
                     player.set_velocity((100, player.get_velocity()[1]))
-                elif get_collision_direction(mob, player) == "B":
+                elif direction == "B":
                     # If player hits top of mushroom, mushroom dies, and player bounces
                     player.set_velocity((player.get_velocity()[0], -BLOCK_SIZE * 7))
                     player.set_jumping(True)
@@ -792,33 +1167,32 @@ class MarioApp:
         """
         # If player leaves block, disallow jump until lands on another block
         self._player.set_jumping(True)
-        # Player is no longer on tunnel. No moving to bonus level
-        if block.get_id() == "tunnel":
-            self._set_on_tunnel(False)
+        handler = self._SEPARATE_HANDLERS.get(block.get_id())
+        if handler is not None:
+            handler(self, player, block)
         return True
 
 
 class BounceBlock(Block):
     """Class of BounceBlock, child of Block"""
-    _id = "bounce"
+    _id = BID.BOUNCE
 
 
 class Flag(Block):
     """Class of Flag, child of Block"""
-    _id = "flag"
-    _cell_size = GOAL_SIZES["flag"]
+    _id = BID.FLAG
+    _cell_size = GOAL_SIZES[_id]
 
 
 class Tunnel(Block):
     """Class of Tunnel, child of Block"""
-    _id = "tunnel"
-    _cell_size = GOAL_SIZES["tunnel"]
+    _id = BID.TUNNEL
+    _cell_size = GOAL_SIZES[_id]
 
 
 class Switch(Block):
     """Class of Switch, child of Block"""
-    _id = "switch"
-    _switch = False
+    _id = BID.SWITCH
     _activated = False
 
     def is_active(self):
@@ -828,19 +1202,13 @@ class Switch(Block):
         """
         return self._activated
 
+    def press(self):
+        """Press the switch"""
+        self._activated = True
 
-class Switch_Pressed(Block):
-    """Class of The pressed Switch block, child of Block"""
-    _id = "switch_pressed"
-    _switch = False
-    _activated = False
-
-    def is_active(self):
-        """
-        Returns:
-        (bool): returns if the switch is pressed
-        """
-        return self._activated
+    def release(self):
+        """Release the switch"""
+        self._activated = False
 
 
 class Mushroom(Mob):
@@ -867,12 +1235,34 @@ class Star(DroppedItem):
         self.invincibility = False
 
 
+# Constructors for the entities which aren't built from their id alone
+BLOCK_FACTORIES = {
+    "mystery_empty": MysteryBlock,
+    "mystery_coin": lambda: MysteryBlock(drop="coin", drop_range=(3, 6)),
+    "bounce_block": BounceBlock,
+    "tunnel": Tunnel,
+    "flag": Flag,
+    "switch": Switch
+}
+
+ITEM_FACTORIES = {
+    "coin": Coin,
+    "star": Star
+}
+
+MOB_FACTORIES = {
+    "cloud": CloudMob,
+    "fireball": Fireball,
+    "mushroom": Mushroom
+}
+
+
 def main():
     root = tk.Tk()
     app = MarioApp(root)
     root.title("Mario Game")
-    app.redraw()
     root.mainloop()
 
 
-main()
+if __name__ == "__main__":
+    main()